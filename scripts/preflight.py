@@ -0,0 +1,190 @@
+from brian2 import *
+import numpy as np
+import os
+import warnings
+
+# Recording preflight, run on a built network before network.run
+# Estimates the peak memory of recording and writing the monitors for simulation_time and,
+# over the memory budget, downgrades the recording: first fewer STSD synapses, then state monitors on a coarser dt
+# Recording modes: 'full', 'reduced_stsd' (every stsd_stride-th synapse), 'subsampled' (every subsample-th step)
+STSD_MONITORS = ('err_stsd_term', 'thalamic_stsd_term')
+FLOAT_BYTES = 8
+INDEX_BYTES = 4
+# Brian's dynamic monitor arrays over-allocate while they grow
+BUFFER_SAFETY_FACTOR = 1.5
+# Copies of the largest monitor array alive at once after the run:
+# writer (unit division + np.array) or pyramid builder (raw read + min/max envelopes)
+WRITE_COPIES = 3
+
+
+# Memory available to new processes in bytes (MemAvailable, counts reclaimable page cache),
+# falls back to free physical memory, None if the platform reports neither
+def available_memory():
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _steps(simulation_time, dt):
+    return int(np.ceil(float(simulation_time / dt) - 1e-9))
+
+
+def _strides(limit):
+    stride = 2
+    while stride < limit:
+        yield stride
+        stride *= 2
+    if limit > 1:
+        yield limit
+
+
+def _collect(monitors, path, recordings):
+    for key, monitor in monitors.items():
+        if isinstance(monitor, dict):
+            _collect(monitor, f'{path}/{key}', recordings)
+        else:
+            recordings.append((monitors, key, f'{path}/{key}', monitor))
+
+
+# layers: {'L1': columns_L1, ...}
+# Returns (owner dict, key, path, monitor) for every monitor, paths follow the HDF5 layout
+def collect_recordings(layers, memory_networks):
+    recordings = []
+    for layer, columns in layers.items():
+        for index, column in enumerate(columns):
+            _collect(column.monitors, f'{layer}_monitors/column_{index+1}', recordings)
+    for index, memory_network in enumerate(memory_networks):
+        _collect(memory_network.monitors, f'memory_monitors/memory_network_{index+1}', recordings)
+    return recordings
+
+
+# Bytes held by one monitor at the end of the run, without over-allocation
+# Spike monitors are estimated from expected_rate
+def monitor_footprint(monitor, key, simulation_time, stsd_stride=1, subsample=1, expected_rate=20*Hz):
+    if isinstance(monitor, StateMonitor):
+        num_recorded = len(monitor.record)
+        if key in STSD_MONITORS:
+            num_recorded = len(range(0, num_recorded, stsd_stride))
+        steps = _steps(simulation_time, subsample*defaultclock.dt)
+        return steps * FLOAT_BYTES * (1 + len(monitor.record_variables) * num_recorded)
+    if isinstance(monitor, PopulationRateMonitor):
+        return _steps(simulation_time, defaultclock.dt) * 2 * FLOAT_BYTES
+    if isinstance(monitor, SpikeMonitor):
+        num_spikes = int(np.ceil(len(monitor.source) * float(expected_rate * simulation_time)))
+        return num_spikes * (INDEX_BYTES + FLOAT_BYTES)
+    return 0
+
+
+# Memory -> prediction weight snapshots taken by FullNetwork.record_weights
+def weight_snapshot_footprint(columns, simulation_time, snapshot_interval=20*ms):
+    snapshots = _steps(simulation_time, snapshot_interval)
+    num_weights = 0
+    for column in columns:
+        if hasattr(column, 'self_weight_snapshots'):
+            num_weights += len(column.syn_mem_pred)
+        if hasattr(column, 'lat_weight_snapshots'):
+            num_weights += len(column.syn_mem_pred_lat)
+    return snapshots * num_weights * FLOAT_BYTES
+
+
+def recording_footprint(recordings, simulation_time, stsd_stride=1, subsample=1, expected_rate=20*Hz):
+    return {path: monitor_footprint(monitor, key, simulation_time, stsd_stride, subsample, expected_rate)
+            for _, key, path, monitor in recordings}
+
+
+# Replaces the monitors in their owner dicts, must happen before the FullNetwork is created
+def apply_recording(recordings, stsd_stride=1, subsample=1):
+    for monitors, key, _, monitor in recordings:
+        if not isinstance(monitor, StateMonitor):
+            continue
+        is_stsd = key in STSD_MONITORS
+        if subsample == 1 and not (is_stsd and stsd_stride > 1):
+            continue
+        record = monitor.record[::stsd_stride] if is_stsd else True
+        monitors[key] = StateMonitor(monitor.source, monitor.record_variables, record=record,
+                                     dt=subsample*defaultclock.dt)
+
+
+def peak_memory(footprints, fixed=0):
+    largest = max(footprints.values(), default=0)
+    return int(BUFFER_SAFETY_FACTOR * (fixed + int(np.sum(list(footprints.values())))) + WRITE_COPIES * largest)
+
+
+# on_over_budget: 'downgrade' picks the finest recording that fits, 'raise' refuses to run,
+# 'warn' runs the full recording anyway; None downgrades for an explicit memory_budget and only warns otherwise
+# memory_budget: bytes, None uses the available memory of the node
+# max_stsd_stride: coarsest STSD synapse subsampling tried before the state monitors are subsampled
+def preflight_recording(layers, memory_networks, simulation_time,
+                        memory_budget=None, on_over_budget=None,
+                        expected_rate=20*Hz, max_stsd_stride=8, max_subsample=64):
+    if on_over_budget is None:
+        on_over_budget = 'warn' if memory_budget is None else 'downgrade'
+    if on_over_budget not in ('downgrade', 'raise', 'warn'):
+        raise ValueError(f"Over budget policy {on_over_budget} not defined!")
+    recordings = collect_recordings(layers, memory_networks)
+    fixed = weight_snapshot_footprint(layers.get('L3', []), simulation_time)
+    if memory_budget is None:
+        memory_budget = available_memory()
+
+    def footprint(stsd_stride, subsample):
+        footprints = recording_footprint(recordings, simulation_time, stsd_stride, subsample, expected_rate)
+        return fixed + int(np.sum(list(footprints.values()))), peak_memory(footprints, fixed)
+
+    recording_bytes, peak_bytes = footprint(1, 1)
+    decision = {
+        'recording_mode': 'full',
+        'stsd_stride': 1,
+        'state_subsample': 1,
+        'recording_bytes': recording_bytes,
+        'peak_bytes': peak_bytes,
+        'full_peak_bytes': peak_bytes,
+        'memory_budget_bytes': -1 if memory_budget is None else int(memory_budget),
+        'max_stsd_stride': max_stsd_stride,
+        'max_subsample': max_subsample,
+    }
+    if memory_budget is None or peak_bytes <= memory_budget:
+        return decision
+    message = f"Recording needs up to {peak_bytes/1e9:.2f} GB, memory budget is {memory_budget/1e9:.2f} GB!"
+    if on_over_budget == 'raise':
+        raise MemoryError(message)
+    if on_over_budget == 'warn':
+        warnings.warn(f"{message} Running with full recording, pass memory_budget to downgrade it.")
+        return decision
+
+    num_stsd = max([len(monitor.record) for _, key, _, monitor in recordings if key in STSD_MONITORS], default=1)
+    stsd_strides = [1, *_strides(min(max_stsd_stride, num_stsd))]
+    for subsample in [1, *_strides(max_subsample)]:
+        for stsd_stride in stsd_strides:
+            recording_bytes, peak_bytes = footprint(stsd_stride, subsample)
+            if peak_bytes <= memory_budget:
+                apply_recording(recordings, stsd_stride, subsample)
+                decision.update({
+                    'recording_mode': 'reduced_stsd' if subsample == 1 else 'subsampled',
+                    'stsd_stride': stsd_stride,
+                    'state_subsample': subsample,
+                    'recording_bytes': recording_bytes,
+                    'peak_bytes': peak_bytes,
+                })
+                warnings.warn(f"{message} Recording downgraded to {decision['recording_mode']} "
+                              f"(stsd_stride={stsd_stride}, state_subsample={subsample}).")
+                return decision
+    raise MemoryError(f"Recording needs up to {footprint(stsd_strides[-1], max_subsample)[1]/1e9:.2f} GB "
+                      f"after downgrading, memory budget is {memory_budget/1e9:.2f} GB!")
+
+
+# (pre, post) neuron pair behind each row of the STSD recordings, like the *_weight_connections datasets
+# Stored under Trial_k/stsd_synapses/ mirroring the raw paths
+def write_stsd_synapses(trial_group, layers, memory_networks):
+    for _, key, path, monitor in collect_recordings(layers, memory_networks):
+        if key in STSD_MONITORS:
+            synapses, record = monitor.source, monitor.record
+            trial_group.create_dataset(f"stsd_synapses/{path}",
+                                       data=np.vstack([synapses.i[record], synapses.j[record]]).T, compression="gzip")
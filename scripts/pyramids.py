@@ -0,0 +1,169 @@
+import numpy as np
+import h5py
+
+# Multi-resolution plot pyramids, stored in a separate 'pyramids' subtree of each trial
+# that mirrors the raw paths, e.g. Trial_1/pyramids/L1_monitors/column_1/error/I_AMPA
+# Traces (rates, currents, STSD terms) are reduced to min/max envelopes,
+# spike rasters to per-neuron spike counts per bin, stored under <neuron group>/spikes
+# Level k has bins of width dt * factor**k, level 0 is always the raw data
+TRACE_NAMES = ('rate', 'I_AMPA', 'I_GABA', 'err_stsd_term', 'thalamic_stsd_term')
+PYRAMID_GROUP = 'pyramids'
+RASTER_NAME = 'spikes'
+
+
+def _level_edges(length, factor):
+    return np.arange(0, length, factor)
+
+
+# Min/max envelope of a trace (or the envelope of a finer envelope) along the time axis
+def _reduce_envelope(lo, hi, factor):
+    edges = _level_edges(lo.shape[-1], factor)
+    return np.minimum.reduceat(lo, edges, axis=-1), np.maximum.reduceat(hi, edges, axis=-1)
+
+
+def _store_level(pyramid, level, bin_width, **arrays):
+    level_group = pyramid.create_group(f"level_{level}")
+    level_group.attrs['bin_width'] = bin_width
+    for name, data in arrays.items():
+        level_group.create_dataset(name, data=data, compression="gzip")
+
+
+def check_pyramid_factor(factor):
+    if int(factor) != factor or factor < 2:
+        raise ValueError(f"Pyramid factor {factor} not defined, must be an integer of at least 2!")
+
+
+def _new_pyramid(trial_group, path):
+    pyramid_path = f"{PYRAMID_GROUP}/{path}"
+    if pyramid_path in trial_group:
+        del trial_group[pyramid_path]
+    return trial_group.create_group(pyramid_path)
+
+
+# path: raw dataset relative to the trial, (T,) or (rows, T), sampled every dt ms starting at t_start ms
+def build_trace_pyramid(trial_group, path, dt, t_start=0.0, factor=4, min_bins=256):
+    factor = int(factor)
+    data = np.asarray(trial_group[path][...])
+    pyramid = _new_pyramid(trial_group, path)
+    pyramid.attrs.update({'dt': dt, 't_start': t_start, 'factor': factor})
+
+    lo, hi = data, data
+    level = 1
+    while -(-lo.shape[-1] // factor) >= min_bins:
+        lo, hi = _reduce_envelope(lo, hi, factor)
+        _store_level(pyramid, level, dt * factor**level, min=lo, max=hi)
+        level += 1
+    pyramid.attrs['num_levels'] = level - 1
+    return pyramid
+
+
+# path: raw neuron group relative to the trial
+# Spike rasters are binned into a (num_neurons, bins) count matrix per level
+def build_raster_pyramid(trial_group, path, num_neurons, num_steps, dt, t_start=0.0, factor=4, min_bins=256):
+    factor = int(factor)
+    group = trial_group[path]
+    spike_indices = np.asarray(group['spike_indices'][...], dtype=int)
+    spike_times = np.asarray(group['spike_times'][...])
+    pyramid = _new_pyramid(trial_group, f"{path}/{RASTER_NAME}")
+    pyramid.attrs.update({'dt': dt, 't_start': t_start, 'factor': factor, 'num_neurons': num_neurons})
+
+    num_bins = -(-num_steps // factor)
+    level = 1
+    if num_bins >= min_bins:
+        bins = np.clip(((spike_times - t_start) / (dt * factor)).astype(int), 0, num_bins - 1)
+        counts = np.zeros((num_neurons, num_bins), dtype=np.uint32)
+        np.add.at(counts, (spike_indices, bins), 1)
+        while True:
+            _store_level(pyramid, level, dt * factor**level, counts=counts)
+            level += 1
+            if -(-counts.shape[-1] // factor) < min_bins:
+                break
+            counts = np.add.reduceat(counts, _level_edges(counts.shape[-1], factor), axis=-1)
+    pyramid.attrs['num_levels'] = level - 1
+    return pyramid
+
+
+# Post-processing stage: builds the pyramids for every trace and raster of a stored trial
+def build_trial_pyramids(trial_group, factor=4, min_bins=256):
+    check_pyramid_factor(factor)
+    factor = int(factor)
+    sim_time = np.asarray(trial_group['sim_time'][...])
+    if len(sim_time) < 2:
+        return
+    dt = float(sim_time[1] - sim_time[0])
+    t_start = float(sim_time[0])
+
+    traces, rasters = [], []
+    def collect(path, item):
+        if path.split('/')[0] not in ('L1_monitors', 'L2_monitors', 'L3_monitors', 'memory_monitors'):
+            return
+        if isinstance(item, h5py.Dataset) and path.split('/')[-1] in TRACE_NAMES:
+            traces.append(path)
+        elif isinstance(item, h5py.Group) and 'spike_times' in item and 'I_AMPA' in item:
+            rasters.append(path)
+    trial_group.visititems(collect)
+
+    for path in traces:
+        build_trace_pyramid(trial_group, path, dt, t_start, factor, min_bins)
+    for path in rasters:
+        build_raster_pyramid(trial_group, path, trial_group[path]['I_AMPA'].shape[0], len(sim_time),
+                             dt, t_start, factor, min_bins)
+
+
+def build_file_pyramids(file_path, factor=4, min_bins=256):
+    with h5py.File(file_path, 'a') as f:
+        for trial in f.keys():
+            build_trial_pyramids(f[trial], factor, min_bins)
+
+
+# Coarsest level whose bins are still no wider than one pixel, 0 means the raw data is needed
+def _select_level(pyramid, t_start, t_stop, pixel_width):
+    pixel_time = (t_stop - t_start) / max(int(pixel_width), 1)
+    level = 0
+    for candidate in range(1, int(pyramid.attrs['num_levels']) + 1):
+        if pyramid[f"level_{candidate}"].attrs['bin_width'] <= pixel_time:
+            level = candidate
+    return level
+
+
+def _window(t0, bin_width, length, t_start, t_stop):
+    first = int(np.clip(np.floor((t_start - t0) / bin_width), 0, length))
+    last = int(np.clip(np.ceil((t_stop - t0) / bin_width) + 1, first, length))
+    return first, last
+
+
+# Returns (level, t, lo, hi) for the raw dataset path (relative to the trial) in the window [t_start, t_stop] ms
+# At level 0 lo and hi are both the raw samples
+def read_trace(trial_group, path, t_start, t_stop, pixel_width):
+    pyramid = trial_group[f"{PYRAMID_GROUP}/{path}"]
+    t0, dt = pyramid.attrs['t_start'], pyramid.attrs['dt']
+    level = _select_level(pyramid, t_start, t_stop, pixel_width)
+    if level == 0:
+        raw = trial_group[path]
+        first, last = _window(t0, dt, raw.shape[-1], t_start, t_stop)
+        data = raw[..., first:last]
+        return 0, t0 + dt * np.arange(first, last), data, data
+
+    level_group = pyramid[f"level_{level}"]
+    bin_width = level_group.attrs['bin_width']
+    first, last = _window(t0, bin_width, level_group['min'].shape[-1], t_start, t_stop)
+    t = t0 + bin_width * np.arange(first, last)
+    return level, t, level_group['min'][..., first:last], level_group['max'][..., first:last]
+
+
+# Returns (level, t, counts) for the raw neuron group path with counts of shape (num_neurons, bins),
+# or (0, spike_times, spike_indices) when the raw raster is needed for this resolution
+def read_raster(trial_group, path, t_start, t_stop, pixel_width):
+    pyramid = trial_group[f"{PYRAMID_GROUP}/{path}/{RASTER_NAME}"]
+    level = _select_level(pyramid, t_start, t_stop, pixel_width)
+    if level == 0:
+        group = trial_group[path]
+        spike_times = np.asarray(group['spike_times'][...])
+        mask = (spike_times >= t_start) & (spike_times <= t_stop)
+        return 0, spike_times[mask], np.asarray(group['spike_indices'][...])[mask]
+
+    t0 = pyramid.attrs['t_start']
+    level_group = pyramid[f"level_{level}"]
+    bin_width = level_group.attrs['bin_width']
+    first, last = _window(t0, bin_width, level_group['counts'].shape[-1], t_start, t_stop)
+    return level, t0 + bin_width * np.arange(first, last), level_group['counts'][:, first:last]
@@ -10,6 +10,8 @@ from scripts.utils import *
 from scripts.memory_networks import *
 from scripts.column import *
 from scripts.full_network import *
+from scripts.pyramids import *
+from scripts.preflight import *
 
 # Simulation function
 def simulate_network(simulation_time,
@@ -17,7 +19,10 @@ def simulate_network(simulation_time,
                      model, parameters, stimulus_time=50*ms,
                      num_simulations=1, num_columns=2, N=40,
                      sim_file_title='Simulation', simulation_folder='/',
-                     store_weights=True, smoothing_width=50*ms):
+                     store_weights=True, smoothing_width=50*ms,
+                     build_plot_pyramids=True, pyramid_factor=4,
+                     memory_budget=None, on_over_budget=None, expected_rate=20*Hz,
+                     max_stsd_stride=8, max_subsample=64):
     
     simulation_data = {}
     simulation_file = f'{sim_file_title}_{strftime("%Y_%m_%d-%H_%M_%S")}.hdf5'
@@ -29,6 +34,10 @@ def simulate_network(simulation_time,
     # Load model parameters
     P = parameters
 
+    # Fail before the run rather than after it
+    if build_plot_pyramids:
+        check_pyramid_factor(pyramid_factor)
+
     for trial in range(num_simulations):
         start_scope()
         
@@ -98,6 +107,18 @@ def simulate_network(simulation_time,
                                              P.stdp_parameters,
                                              store_weights=store_weights)
         
+        # Check the recording footprint against the memory budget, may replace monitors with reduced ones
+        layers = {'L1': columns_L1, 'L2': columns_L2, 'L3': columns_L3}
+        recording = preflight_recording(layers, memory_networks, simulation_time,
+                                        memory_budget=memory_budget,
+                                        on_over_budget=on_over_budget,
+                                        expected_rate=expected_rate,
+                                        max_stsd_stride=max_stsd_stride,
+                                        max_subsample=max_subsample)
+        print(f"Recording: {recording['recording_mode']} (up to {recording['peak_bytes']/1e9:.2f} GB)")
+        # Rates are recorded every clock step, stored on the same (possibly subsampled) time axis as sim_time
+        rate_step = recording['state_subsample']
+
         # Create a network from these columns for simulations
         network = FullNetwork(thalamic_neurons,
                               columns_L1, columns_L2, columns_L3,
@@ -130,6 +151,7 @@ def simulate_network(simulation_time,
         # Storing all the data to HDF5 files
         with h5py.File(f'./simulation_data/{simulation_folder}/{simulation_file}', 'a') as f:
             trial_group = f.create_group(f"Trial_{trial+1}")
+            trial_group.attrs.update(recording)
             sim_time = trial_group.create_dataset("sim_time", data=np.array(columns_L1[0].monitors['error']['I_AMPA'].t/ms), compression="gzip")
             
             L1_monitors = trial_group.create_group("L1_monitors")
@@ -145,7 +167,7 @@ def simulate_network(simulation_time,
                     group = column_group.create_group(neuron_group)
                     group.create_dataset("spike_indices", data=np.array(columns_L1[col_index].monitors[neuron_group]['spikes'].i), compression="gzip")
                     group.create_dataset("spike_times", data=np.array(columns_L1[col_index].monitors[neuron_group]['spikes'].t/ms), compression="gzip")
-                    group.create_dataset("rate", data=np.array(columns_L1[col_index].monitors[neuron_group]['rate'].smooth_rate(window='flat', width=smoothing_width)/Hz), compression="gzip")
+                    group.create_dataset("rate", data=np.array(columns_L1[col_index].monitors[neuron_group]['rate'].smooth_rate(window='flat', width=smoothing_width)[::rate_step]/Hz), compression="gzip")
                     group.create_dataset("I_AMPA", data=np.array(columns_L1[col_index].monitors[neuron_group]['I_AMPA'].I_AMPA/pA), compression="gzip")
                     group.create_dataset("I_GABA", data=np.array(columns_L1[col_index].monitors[neuron_group]['I_GABA'].I_GABA/pA), compression="gzip")
 
@@ -159,7 +181,7 @@ def simulate_network(simulation_time,
                     group = column_group.create_group(neuron_group)
                     group.create_dataset("spike_indices", data=np.array(columns_L2[col_index].monitors[neuron_group]['spikes'].i), compression="gzip")
                     group.create_dataset("spike_times", data=np.array(columns_L2[col_index].monitors[neuron_group]['spikes'].t/ms), compression="gzip")
-                    group.create_dataset("rate", data=np.array(columns_L2[col_index].monitors[neuron_group]['rate'].smooth_rate(window='flat', width=smoothing_width)/Hz), compression="gzip")
+                    group.create_dataset("rate", data=np.array(columns_L2[col_index].monitors[neuron_group]['rate'].smooth_rate(window='flat', width=smoothing_width)[::rate_step]/Hz), compression="gzip")
                     group.create_dataset("I_AMPA", data=np.array(columns_L2[col_index].monitors[neuron_group]['I_AMPA'].I_AMPA/pA), compression="gzip")
                     group.create_dataset("I_GABA", data=np.array(columns_L2[col_index].monitors[neuron_group]['I_GABA'].I_GABA/pA), compression="gzip")
 
@@ -181,7 +203,7 @@ def simulate_network(simulation_time,
                     group.create_dataset("spike_indices", data=np.array(columns_L3[col_index].monitors[neuron_group]['spikes'].i), compression="gzip")
                     group.create_dataset("spike_times", data=np.array(columns_L3[col_index].monitors[neuron_group]['spikes'].t/ms), compression="gzip")
                     group.create_dataset("rate",
-                          data=np.array(columns_L3[col_index].monitors[neuron_group]['rate'].smooth_rate(window='flat', width=smoothing_width)/Hz), compression="gzip")
+                          data=np.array(columns_L3[col_index].monitors[neuron_group]['rate'].smooth_rate(window='flat', width=smoothing_width)[::rate_step]/Hz), compression="gzip")
                     group.create_dataset("I_AMPA", data=np.array(columns_L3[col_index].monitors[neuron_group]['I_AMPA'].I_AMPA/pA), compression="gzip")
                     group.create_dataset("I_GABA", data=np.array(columns_L3[col_index].monitors[neuron_group]['I_GABA'].I_GABA/pA), compression="gzip")
 
@@ -190,9 +212,17 @@ def simulate_network(simulation_time,
                 memory_group = memory_monitors.create_group(f"memory_network_{index+1}")
                 spike_indices = memory_group.create_dataset("spike_indices", data=np.array(memory_networks[index].monitors['spikes'].i), compression="gzip")
                 spike_times = memory_group.create_dataset("spike_times", data=np.array(memory_networks[index].monitors['spikes'].t/ms), compression="gzip")
-                rate = memory_group.create_dataset("rate", data=np.array(memory_networks[index].monitors['rate'].smooth_rate(window='flat', width=smoothing_width)/Hz), compression="gzip")
+                rate = memory_group.create_dataset("rate", data=np.array(memory_networks[index].monitors['rate'].smooth_rate(window='flat', width=smoothing_width)[::rate_step]/Hz), compression="gzip")
                 I_AMPA = memory_group.create_dataset("I_AMPA", data=np.array(memory_networks[index].monitors['I_AMPA'].I_AMPA/pA), compression="gzip")
                 I_GABA = memory_group.create_dataset("I_GABA", data=np.array(memory_networks[index].monitors['I_GABA'].I_GABA/pA), compression="gzip")
 
+            # Synapses behind the rows of reduced STSD recordings
+            if recording['stsd_stride'] > 1:
+                write_stsd_synapses(trial_group, layers, memory_networks)
+
+            # Downsampled min/max envelopes and binned rasters for plotting, read back with read_trace/read_raster
+            if build_plot_pyramids:
+                build_trial_pyramids(trial_group, factor=pyramid_factor)
+
             print(f'Simulation data stored in file: {simulation_file}!')
     return network
\ No newline at end of file